@@ -1,10 +1,16 @@
 import numpy as np
 import random
-from collections import namedtuple, deque
+import inspect
+import contextlib
+import queue
+import threading
+import weakref
+from numba import njit, prange
 
 from model import QNetwork
 
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
@@ -14,13 +20,20 @@ GAMMA = 0.99            # discount factor
 TAU = 1e-3              # for soft update of target parameters
 LR = 5e-4               # learning rate 
 UPDATE_EVERY = 4        # how often to update the network
+GRAPH_WARMUP = 3        # learning steps run eagerly before capturing them as a CUDA graph
+PREFETCH = 2            # batches sampled and uploaded ahead of learning
+PREFETCH_TIMEOUT = 1.0  # seconds between liveness checks while waiting on the prefetch queue
+GPU_REPLAY = False      # keep the replay buffer in device memory when running on CUDA, this bypasses
+                        # the pinned staging, prefetching and Numba sampling paths and delays learning
+                        # until UPDATE_BLOCK experiences have been copied to the device
+UPDATE_BLOCK = 1024     # experiences gathered on the host before being copied to a device-resident buffer
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 class Agent():
     """Interacts with and learns from the environment."""
 
-    def __init__(self, action_size, frame_history=4, seed=42):
+    def __init__(self, action_size, frame_history=4, seed=42, frame_shape=(84, 84)):
         """Initialize an Agent object.
         
         Params
@@ -28,6 +41,7 @@ class Agent():
             action_size (int): Dimension of each action
             frame_history (int): Number of continuous frames to be considered in each state 
             seed (int): Random seed
+            frame_shape (tuple): Shape (height, width) of a single pre-processed frame
         """
         self.action_size = action_size
         self.seed = random.seed(seed)
@@ -35,24 +49,109 @@ class Agent():
         # Q-Network
         self.qnetwork_local = QNetwork(action_size, frame_history, seed).to(device)
         self.qnetwork_target = QNetwork(action_size, frame_history, seed).to(device)
-        self.optimizer = optim.Adam(self.qnetwork_local.parameters(), lr=LR)
+        # the learning step is captured as a CUDA graph on GPU, which needs a capturable
+        # optimizer (PyTorch 1.12+), otherwise it runs eagerly
+        self.use_learn_graph = device.type == 'cuda' and 'capturable' in inspect.signature(optim.Adam).parameters
+        optimizer_kwargs = {'capturable': True} if self.use_learn_graph else {}
+        self.optimizer = optim.Adam(self.qnetwork_local.parameters(), lr=LR, **optimizer_kwargs)
+        # parameter lists blended by every soft update
+        self.local_params = list(self.qnetwork_local.parameters())
+        self.target_params = list(self.qnetwork_target.parameters())
+        # device-side constants of the Q target, so learning needs no scalar promotion
+        self.gamma = GAMMA
+        self.gamma_t = torch.tensor(GAMMA, device=device)
+        self.one_t = torch.tensor(1.0, device=device)
+        # reduced precision for the target network forward on CUDA only (torch.autocast
+        # needs PyTorch 1.10+), with float16 on GPUs without bfloat16 support
+        self.target_autocast = device.type == 'cuda' and hasattr(torch, 'autocast')
+        self.target_dtype = torch.bfloat16
+        if self.target_autocast and not torch.cuda.is_bf16_supported():
+            self.target_dtype = torch.float16
+
+        # Persistent input tensors for act(), the host side is pinned when on GPU
+        self.act_pin = torch.empty((1, frame_history, *frame_shape), dtype=torch.float32, pin_memory=device.type == 'cuda')
+        self.act_gpu = self.act_pin.to(device)
+        # act() only needs to switch modes when the network has layers behaving differently in eval
+        self._needs_eval_toggle = any(isinstance(m, (nn.modules.batchnorm._BatchNorm, nn.modules.dropout._DropoutNd))
+                                      for m in self.qnetwork_local.modules())
 
         # Replay memory
-        self.memory = ReplayBuffer(action_size, BUFFER_SIZE, BATCH_SIZE, frame_history, seed)
+        self.memory = ReplayBuffer(action_size, BUFFER_SIZE, BATCH_SIZE, frame_history, seed, frame_shape,
+                                   gpu_resident=GPU_REPLAY and device.type == 'cuda', block_size=UPDATE_BLOCK)
         # Initialize time step (for updating every UPDATE_EVERY steps)
         self.t_step = 0
+
+        # CUDA graph replaying a whole learning step, captured after GRAPH_WARMUP eager steps
+        self.learn_graph = None
+        self.static_experiences = None
+        self.warmup_steps = 0
+
+        # Background thread sampling and uploading batches ahead of learn()
+        self.prefetch_queue = queue.Queue(maxsize=PREFETCH)
+        self.prefetch_stop = threading.Event()
+        self.prefetch_thread = None
+        # the thread does not reference the agent, so a dropped agent is collected and stops it
+        weakref.finalize(self, self.prefetch_stop.set)
     
     def step(self, state, action, reward, next_state, done):
-        # Save experience in replay memory
-        self.memory.add(state, action, reward, next_state, done)
-        
-        # Learn every UPDATE_EVERY time steps.
-        self.t_step = (self.t_step + 1) % UPDATE_EVERY
-        if self.t_step == 0:
-            # If enough samples are available in memory, get random subset and learn
-            if len(self.memory) > BATCH_SIZE:
-                experiences = self.memory.sample()
-                self.learn(experiences, GAMMA)
+        # Save experience in replay memory, only the newest frame of the state is kept
+        # since stacked states are rebuilt from consecutive frames at sample time.
+        # Learn every UPDATE_EVERY time steps, if enough samples are available in memory.
+        self.t_step, should_learn = self.memory.add_and_tick(state[-1], action, reward, done, self.t_step, UPDATE_EVERY)
+        if should_learn:
+            experiences = self._next_batch()
+            self.learn(experiences, GAMMA)
+
+    def _next_batch(self):
+        """Return a training batch, prefetched in the background once the learning graph is captured.
+
+        Prefetching waits for the capture because a capture must not race with
+        other CUDA work, and it is CUDA only since on CPU sampled batches share
+        the replay buffer's staging tensors. A device-resident buffer samples
+        without any host to device copy, so there is nothing to overlap.
+        """
+        if self.learn_graph is None or self.memory.gpu_resident:
+            return self.memory.sample()
+        if self.prefetch_thread is None:
+            self.prefetch_thread = threading.Thread(
+                target=Agent._prefetch, args=(self.memory, self.prefetch_queue, self.prefetch_stop), daemon=True)
+            self.prefetch_thread.start()
+
+        while True:
+            try:
+                batch = self.prefetch_queue.get(timeout=PREFETCH_TIMEOUT)
+            except queue.Empty:
+                if not self.prefetch_thread.is_alive():
+                    raise RuntimeError("prefetch thread stopped without producing a batch")
+                continue
+            # errors raised while sampling are handed over by the producer
+            if isinstance(batch, Exception):
+                raise batch
+            return batch
+
+    @staticmethod
+    def _prefetch(memory, batches, stop):
+        """Keep the prefetch queue filled with batches already copied to the device, until stop is set."""
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=PREFETCH_TIMEOUT)
+                    return
+                except queue.Full:
+                    pass
+
+        try:
+            while not stop.is_set():
+                put(memory.sample())
+        except Exception as e:
+            put(e)
+
+    def close(self):
+        """Stop the background prefetch thread, if it was started."""
+        self.prefetch_stop.set()
+        if self.prefetch_thread is not None:
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
 
     def act(self, state, eps=0.):
         """Returns actions for given state as per current policy.
@@ -65,70 +164,188 @@ class Agent():
 
         # Epsilon-greedy action selection
         if random.random() > eps:
-            state = torch.from_numpy(state).float().unsqueeze(0).to(device)
+            self.act_pin.copy_(torch.from_numpy(state))
+            self.act_gpu.copy_(self.act_pin, non_blocking=True)
             
-            self.qnetwork_local.eval()
+            if self._needs_eval_toggle:
+                self.qnetwork_local.eval()
             with torch.no_grad():
-                action_values = self.qnetwork_local(state)
-            self.qnetwork_local.train()
+                action = self.qnetwork_local(self.act_gpu).argmax(1).item()
+            if self._needs_eval_toggle:
+                self.qnetwork_local.train()
             
-            return np.argmax(action_values.cpu().data.numpy())
+            return action
         else:
             return random.choice(np.arange(self.action_size))
 
     def learn(self, experiences, gamma):
         """Update value parameters using given batch of experience tuples.
 
+        On CUDA with PyTorch 1.12+ the step is captured once as a graph and replayed for every
+        following batch. Gamma is read from a device tensor, so it may still change.
+
         Params
         ======
             experiences (Tuple[torch.Variable]): tuple of (s, a, r, s', done) tuples 
             gamma (float): discount factor
         """
+        if gamma != self.gamma:
+            self.gamma = gamma
+            self.gamma_t.fill_(gamma)
+
+        if not self.use_learn_graph:
+            self._learn_step(experiences)
+            return
+
+        if self.learn_graph is None:
+            if self.warmup_steps < GRAPH_WARMUP:
+                # warm up on a side stream so lazily created state (cuDNN plans,
+                # Adam moments) exists before capture
+                side_stream = torch.cuda.Stream()
+                side_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(side_stream):
+                    self._learn_step(experiences)
+                torch.cuda.current_stream().wait_stream(side_stream)
+                self.warmup_steps += 1
+                return
+            self._capture_learn_graph(experiences)
+
+        for static, tensor in zip(self.static_experiences, experiences):
+            static.copy_(tensor)
+        self.learn_graph.replay()
+
+    def _capture_learn_graph(self, experiences):
+        """Record one learning step over static input tensors as a CUDA graph."""
+        self.static_experiences = tuple(t.clone() for t in experiences)
+        self.learn_graph = torch.cuda.CUDAGraph()
+        self.optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(self.learn_graph):
+            self._learn_step(self.static_experiences)
+
+    def _learn_step(self, experiences):
+        """Run the forward, backward, optimizer step and soft update for one batch."""
         states, actions, rewards, next_states, dones = experiences
+        batch_size = states.size(0)
+
+        # Run the local model once over both current and next states
+        Q_local = self.qnetwork_local(torch.cat([states, next_states], 0))
         
         ################
         # Double DQN   #
         ################
         # Get predicted Q values (for next states) from target model
         # corresponding to the max Q value action predicted by the local model
-        next_state_actions = self.qnetwork_local(next_states).detach().max(1, keepdim=True)[1]
-        Q_targets_next = self.qnetwork_target(next_states).detach().gather(1, next_state_actions)
+        with torch.no_grad():
+            next_state_actions = Q_local[batch_size:].argmax(1, keepdim=True)
+            # the target network only provides bootstrap values, so it runs in reduced precision
+            # (autocast caching is off since the step may be captured as a CUDA graph)
+            with self._target_precision():
+                Q_next_target = self.qnetwork_target(next_states)
+            Q_targets_next = Q_next_target.float().gather(1, next_state_actions)
         
-        # Compute Q targets for current states 
-        Q_targets = rewards + (gamma * Q_targets_next * (1 - dones))
+        # Compute Q targets for current states, rewards + gamma * Q_targets_next * (1 - dones) in one fused op
+        not_done = torch.sub(self.one_t, dones)
+        Q_targets = torch.addcmul(rewards, Q_targets_next.mul_(self.gamma_t), not_done)
 
         # Get expected Q values from local model
-        Q_expected = self.qnetwork_local(states).gather(1, actions)
+        Q_expected = Q_local[:batch_size].gather(1, actions)
 
         # Compute loss
         loss = F.smooth_l1_loss(Q_expected, Q_targets)
         
         # Minimize the loss
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
         loss.backward()
         self.optimizer.step()
 
         # ------------------- update target network ------------------- #
-        self.soft_update(self.qnetwork_local, self.qnetwork_target, TAU)                     
+        self.soft_update(self.local_params, self.target_params, TAU)                     
 
-    def soft_update(self, local_model, target_model, tau):
+    def _target_precision(self):
+        """Context the target network forward runs in, autocast on CUDA and a no-op otherwise."""
+        if not self.target_autocast:
+            # contextlib.nullcontext needs Python 3.7, an empty suppress does nothing as well
+            return contextlib.suppress()
+        return torch.autocast(device.type, dtype=self.target_dtype, cache_enabled=False)
+
+    def soft_update(self, local_params, target_params, tau):
         """Soft update model parameters.
         θ_target = τ*θ_local + (1 - τ)*θ_target
 
         Params
         ======
-            local_model (PyTorch model): weights will be copied from
-            target_model (PyTorch model): weights will be copied to
+            local_params (List[torch.Tensor]): weights will be copied from
+            target_params (List[torch.Tensor]): weights will be copied to
             tau (float): interpolation parameter 
         """
-        for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
-            target_param.data.copy_(tau*local_param.data + (1.0-tau)*target_param.data)
+        with torch.no_grad():
+            if hasattr(torch, '_foreach_lerp_'):
+                torch._foreach_lerp_(target_params, local_params, tau)
+            else:
+                # older PyTorch has no fused foreach lerp
+                for target_param, local_param in zip(target_params, local_params):
+                    target_param.lerp_(local_param, tau)
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def encode_batch(frames, dones, idxs, frame_history, pos, size, out):
+    """Stack the frame_history frames ending at each of idxs into out, zeroing frames from an earlier context.
+
+    Params
+    ======
+        frames (np.ndarray): ring of single uint8 frames, shape (buffer_size, H, W)
+        dones (np.ndarray): ring of done flags, shape (buffer_size,)
+        idxs (np.ndarray): slot of the newest frame of each stack
+        frame_history (int): number of frames in each stack
+        pos (int): next slot to be written in the ring
+        size (int): number of filled slots in the ring
+        out (np.ndarray): uint8 output, shape (len(idxs), frame_history, H, W)
+    """
+    n = frames.shape[0]
+    newest = (pos - 1) % n
+    for b in prange(idxs.shape[0]):
+        first = idxs[b] - frame_history + 1
+        # a context ends at an episode end, at the write head where the newest
+        # frame borders the oldest one, or before the first frame ever stored
+        start = 0
+        for i in range(frame_history - 2, -1, -1):
+            j = first + i
+            if (j < 0 and size < n) or dones[j % n] or j % n == newest:
+                start = i + 1
+                break
+        out[b, :start] = 0
+        for i in range(start, frame_history):
+            out[b, i] = frames[(first + i) % n]
+
+
+@njit(cache=True)
+def _write_slot(frames, actions, rewards, dones, pos, size, frame, action, reward, done):
+    """Write an experience at pos and return the new (pos, size) of the ring."""
+    n = frames.shape[0]
+    frames[pos] = frame
+    actions[pos] = action
+    rewards[pos] = reward
+    dones[pos] = done
+    return (pos + 1) % n, min(size + 1, n)
+
+
+@njit(cache=True)
+def _add_and_tick(frames, actions, rewards, dones, pos, size, t_step, frame, action, reward, done,
+                  update_every, batch_size):
+    """Write an experience at pos and advance the step counter.
+
+    Returns the new (pos, size, t_step) and whether it is time to learn from a batch.
+    """
+    pos, size = _write_slot(frames, actions, rewards, dones, pos, size, frame, action, reward, done)
+    t_step = (t_step + 1) % update_every
+    return pos, size, t_step, t_step == 0 and size > batch_size
 
 
 class ReplayBuffer:
-    """Fixed-size buffer to store experience tuples."""
+    """Fixed-size ring buffer storing experience fields in preallocated arrays."""
 
-    def __init__(self, action_size, buffer_size, batch_size, frame_history, seed):
+    def __init__(self, action_size, buffer_size, batch_size, frame_history, seed, frame_shape=(84, 84),
+                 gpu_resident=False, block_size=1024):
         """Initialize a ReplayBuffer object.
 
         Params
@@ -138,69 +355,230 @@ class ReplayBuffer:
             batch_size (int): size of each training batch
             frame_history (int): number of continuous frames to be considered in each state 
             seed (int): random seed
+            frame_shape (tuple): shape (height, width) of a single frame
+            gpu_resident (bool): keep the ring in device memory and sample it there (CUDA only)
+            block_size (int): experiences gathered on the host before each copy to a device-resident ring
         """
         self.action_size = action_size
         self.buffer_size = buffer_size
-        self.memory = deque(maxlen=buffer_size)  
         self.batch_size = batch_size
         self.frame_history = frame_history
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
         self.seed = random.seed(seed)
+        self.rng = np.random.default_rng(seed)
+        # guards the ring against a prefetching thread sampling while add() writes
+        self.lock = threading.Lock()
+        # persistent buffers the sampled indices are drawn into
+        self.uniform_buf = np.empty(batch_size)
+        self.idx_buf = np.empty(batch_size, dtype=np.int64)
+
+        self.pos = 0        # next slot to be written
+        self.size = 0       # number of filled slots
+        # host to device copies run on their own stream so they overlap queued learning work
+        self.copy_stream = torch.cuda.Stream() if device.type == 'cuda' else None
+        self.copy_event = None
+
+        self.gpu_resident = gpu_resident
+        if gpu_resident:
+            self._init_device_ring(frame_shape, block_size, seed)
+            return
+
+        self.frames = np.empty((buffer_size, *frame_shape), dtype=np.uint8)
+        self.actions = np.empty(buffer_size, dtype=np.int64)
+        self.rewards = np.empty(buffer_size, dtype=np.float32)
+        self.dones = np.empty(buffer_size, dtype=np.bool_)
+
+        # Persistent (pinned when on GPU) staging tensors, refilled in place by every sample
+        pin = device.type == 'cuda'
+        state_shape = (batch_size, frame_history, *frame_shape)
+        self.states_pin = torch.empty(state_shape, dtype=torch.uint8, pin_memory=pin)
+        self.actions_pin = torch.empty((batch_size, 1), dtype=torch.int64, pin_memory=pin)
+        self.rewards_pin = torch.empty((batch_size, 1), dtype=torch.float32, pin_memory=pin)
+        self.next_states_pin = torch.empty(state_shape, dtype=torch.uint8, pin_memory=pin)
+        self.dones_pin = torch.empty((batch_size, 1), dtype=torch.float32, pin_memory=pin)
+        # NumPy views sharing storage with the staging tensors, gathered into without copies
+        self.states_np = self.states_pin.numpy()
+        self.actions_np = self.actions_pin.numpy().reshape(-1)
+        self.rewards_np = self.rewards_pin.numpy().reshape(-1)
+        self.next_states_np = self.next_states_pin.numpy()
+
+    def _init_device_ring(self, frame_shape, block_size, seed):
+        """Allocate the device-resident ring and the pinned host block feeding it."""
+        n = self.buffer_size
+        self.gpu_frames = torch.empty((n, *frame_shape), dtype=torch.uint8, device=device)
+        self.gpu_actions = torch.empty(n, dtype=torch.int64, device=device)
+        self.gpu_rewards = torch.empty(n, dtype=torch.float32, device=device)
+        self.gpu_dones = torch.empty(n, dtype=torch.bool, device=device)
+        self.gpu_rng = torch.Generator(device=device)
+        self.gpu_rng.manual_seed(seed)
+        # offsets of the frames stacked into a state, relative to its newest frame
+        self.window_offsets = torch.arange(1 - self.frame_history, 1, device=device)
+
+        # experiences are written to a pinned block and copied to the ring once it fills
+        self.block_size = block_size
+        self.block_fill = 0
+        self.block_frames = torch.empty((block_size, *frame_shape), dtype=torch.uint8, pin_memory=True)
+        self.block_actions = torch.empty(block_size, dtype=torch.int64, pin_memory=True)
+        self.block_rewards = torch.empty(block_size, dtype=torch.float32, pin_memory=True)
+        self.block_dones = torch.empty(block_size, dtype=torch.bool, pin_memory=True)
+        self.block_frames_np = self.block_frames.numpy()
+        self.block_actions_np = self.block_actions.numpy()
+        self.block_rewards_np = self.block_rewards.numpy()
+        self.block_dones_np = self.block_dones.numpy()
     
-    def add(self, state, action, reward, next_state, done):
-        """Add a new experience to memory."""
-        e = self.experience(state, action, reward, next_state, done)
-        self.memory.append(e)
+    def add(self, frame, action, reward, done):
+        """Add a new experience to memory.
+
+        Only the newest frame is stored, the stacked state and next state
+        are rebuilt from neighbouring slots by encode_batch.
+        """
+        if self.gpu_resident:
+            self._add_to_block(frame, action, reward, done)
+            return
+
+        with self.lock:
+            self.pos, self.size = _write_slot(
+                self.frames, self.actions, self.rewards, self.dones, self.pos, self.size,
+                frame, action, reward, done)
     
-    def _encode_state(self, idx):
-        """Helper function to append context history to a state specified by idx in memory"""
-        end_idx   = idx + 1 # make noninclusive
-        start_idx = end_idx - self.frame_history
-        n = len(self.memory)
-        # if there weren't enough frames ever in the buffer for context
-        if start_idx < 0:
-            start_idx = 0
-        for idx in range(start_idx, end_idx - 1):
-            if self.memory[idx % n].done:
-                start_idx = idx + 1
-        missing_context = self.frame_history - (end_idx - start_idx)
-        # if zero padding is needed for missing context
-        # or we are on the boundry of the buffer
-        frames = []
-        if start_idx < 0 or missing_context > 0:
-            frames = [np.zeros_like(self.memory[0].state) for _ in range(missing_context)]
-            for idx in range(start_idx, end_idx):
-                frames.append(self.memory[idx % n].state)
-        else:
-            for idx in range(start_idx, end_idx):
-                frames.append(self.memory[idx % n].state)
-                
-        return np.expand_dims(np.array(np.concatenate(frames, 0) / 255.0, dtype=np.float32), axis=0) # normalize by 255
-        
-    def get_experiences(self, experiences_idx):
-        """Create experiences where states have a context history in them"""
-        experiences = []
-        for idx in experiences_idx:
-            state = self._encode_state(idx)
-            next_state = self._encode_state(idx+1)
-            e = self.experience(state, self.memory[idx].action, self.memory[idx].reward, next_state, self.memory[idx].done)
-            experiences.append(e)
-            
-        return experiences
+    def add_and_tick(self, frame, action, reward, done, t_step, update_every):
+        """Add a new experience to memory and advance the learning step counter.
+
+        Returns the new step counter and whether a batch should be learned from now.
+        """
+        if self.gpu_resident:
+            self._add_to_block(frame, action, reward, done)
+            t_step = (t_step + 1) % update_every
+            return t_step, t_step == 0 and self.size > self.batch_size
+
+        with self.lock:
+            self.pos, self.size, t_step, should_learn = _add_and_tick(
+                self.frames, self.actions, self.rewards, self.dones, self.pos, self.size, t_step,
+                frame, action, reward, done, update_every, self.batch_size)
+        return t_step, should_learn
+
+    def _add_to_block(self, frame, action, reward, done):
+        """Write an experience to the pinned host block, copying the block to the device ring when full."""
+        if self.block_fill == 0 and self.copy_event is not None:
+            # the previous block must have left the pinned memory before it is overwritten
+            self.copy_event.synchronize()
+        i = self.block_fill
+        self.block_frames_np[i] = frame
+        self.block_actions_np[i] = action
+        self.block_rewards_np[i] = reward
+        self.block_dones_np[i] = done
+        self.block_fill += 1
+        if self.block_fill == self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        """Copy the pending block to the device ring at the write head, in two parts if it wraps."""
+        n = self.buffer_size
+        count = self.block_fill
+        first = min(count, n - self.pos)
+        segments = ((self.pos, 0, first), (0, first, count - first))
+        fields = ((self.gpu_frames, self.block_frames), (self.gpu_actions, self.block_actions),
+                  (self.gpu_rewards, self.block_rewards), (self.gpu_dones, self.block_dones))
+        # the block overwrites the oldest slots, which gathers still queued on the
+        # compute stream may read, so the copies wait for them
+        self.copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.copy_stream):
+            for dst_start, src_start, length in segments:
+                if length == 0:
+                    continue
+                for dst, src in fields:
+                    dst[dst_start:dst_start + length].copy_(src[src_start:src_start + length], non_blocking=True)
+            self.copy_event = torch.cuda.Event()
+            self.copy_event.record()
+        # sampling waits for the new block on the GPU only
+        torch.cuda.current_stream().wait_event(self.copy_event)
+
+        self.pos = (self.pos + count) % n
+        self.size = min(self.size + count, n)
+        self.block_fill = 0
+
+    def _encode_device(self, idxs):
+        """Stack the frame_history frames ending at each of idxs by gathering from the device ring."""
+        n = self.buffer_size
+        windows = idxs.unsqueeze(1) + self.window_offsets
+        slots = windows.remainder(n)
+        # a context ends at an episode end, at the write head where the newest
+        # frame borders the oldest one, or before the first frame ever stored
+        ends = self.gpu_dones[slots[:, :-1]] | (slots[:, :-1] == (self.pos - 1) % n)
+        if self.size < n:
+            ends |= windows[:, :-1] < 0
+        # every frame at or before the last context end is stale
+        stale = ends.flip(1).cumsum(1).flip(1) > 0
+        frames = self.gpu_frames[slots]
+        frames[:, :-1].masked_fill_(stale[:, :, None, None], 0)
+        return frames
+
+    def _sample_device(self):
+        """Sample a batch from the device-resident ring without any host to device copy."""
+        n = self.buffer_size
+        # draw among all filled slots but the newest, which has no next state yet
+        offsets = torch.randint(0, self.size - 1, (self.batch_size,), device=device, generator=self.gpu_rng)
+        idxs = offsets.add_(self.pos - self.size).remainder_(n)
+
+        states = self._encode_device(idxs).float().div_(255.0)
+        actions = self.gpu_actions[idxs].unsqueeze(1)
+        rewards = self.gpu_rewards[idxs].unsqueeze(1)
+        next_states = self._encode_device(idxs + 1).float().div_(255.0)
+        dones = self.gpu_dones[idxs].float().unsqueeze(1)
+
+        return (states, actions, rewards, next_states, dones)
     
     def sample(self):
         """Randomly sample a batch of experiences from memory."""
-        experiences_idx = random.sample(range(len(self.memory)), k=self.batch_size)
-        experiences = self.get_experiences(experiences_idx)
-
-        states = torch.from_numpy(np.vstack([e.state for e in experiences if e is not None])).float().to(device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).long().to(device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(device)
-        next_states = torch.from_numpy(np.vstack([e.next_state for e in experiences if e is not None])).float().to(device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(device)
+        # the newest experience is never sampled, so at least one other must exist
+        if self.size < 2:
+            raise ValueError("need at least 2 experiences in memory to sample, got {}".format(self.size))
+        if self.gpu_resident:
+            return self._sample_device()
+
+        # the previous batch must have left the pinned tensors before they are refilled
+        if self.copy_event is not None:
+            self.copy_event.synchronize()
+
+        with self.lock:
+            # Generator.integers has no out argument, so scale uniforms in place
+            # and truncate them into the index buffer
+            self.rng.random(out=self.uniform_buf)
+            self.uniform_buf *= self.size
+            idxs = self.idx_buf
+            idxs[:] = self.uniform_buf
+            # the newest experience has no next state yet, redraw it
+            newest = (self.pos - 1) % self.buffer_size
+            rejected = idxs == newest
+            while rejected.any():
+                idxs[rejected] = self.rng.integers(0, self.size, rejected.sum())
+                rejected = idxs == newest
+
+            encode_batch(self.frames, self.dones, idxs, self.frame_history, self.pos, self.size, self.states_np)
+            np.take(self.actions, idxs, out=self.actions_np)
+            np.take(self.rewards, idxs, out=self.rewards_np)
+            encode_batch(self.frames, self.dones, idxs + 1, self.frame_history, self.pos, self.size, self.next_states_np)
+            # bool to float conversion happens inside the copy
+            self.dones_pin.copy_(torch.from_numpy(self.dones[idxs]).unsqueeze(1))
+        experiences = (self.states_pin, self.actions_pin, self.rewards_pin, self.next_states_pin, self.dones_pin)
+
+        if self.copy_stream is not None:
+            with torch.cuda.stream(self.copy_stream):
+                experiences = tuple(t.to(device, non_blocking=True) for t in experiences)
+                self.copy_event = torch.cuda.Event()
+                self.copy_event.record()
+            # learning waits for the copies on the GPU only, the host keeps going
+            compute_stream = torch.cuda.current_stream()
+            compute_stream.wait_event(self.copy_event)
+            for t in experiences:
+                t.record_stream(compute_stream)
+
+        # frames travel as uint8 and are normalized by 255 on the device
+        states, actions, rewards, next_states, dones = experiences
+        states = states.float().div_(255.0)
+        next_states = next_states.float().div_(255.0)
   
         return (states, actions, rewards, next_states, dones)
 
     def __len__(self):
         """Return the current size of internal memory."""
-        return len(self.memory)
\ No newline at end of file
+        return self.size